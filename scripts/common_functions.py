@@ -8,6 +8,41 @@ the other scripts in this repo.
 This file can also be imported as a module.
 """
 
+import csv
+import functools
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from os.path import dirname, join
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson decodes the API responses faster when it is installed,
+# otherwise fall back to the json module in the standard library
+try:
+    import orjson as json_lib
+except ImportError:
+    import json as json_lib
+
+# The folder containing these scripts, where the gh_key file is stored
+_HERE = dirname(__file__)
+
+# API responses are cached in a folder called "cache" next to these
+# scripts for this many seconds, so that running a script again soon
+# afterwards doesn't need to query the API again. Set to 0 to disable.
+CACHE_TTL = 30 * 60
+
+# When fewer than this many requests are left in the hourly rate limit,
+# post_query waits for the limit to reset instead of running it down to 0
+RATE_LIMIT_BUFFER = 100
+
+@functools.lru_cache(maxsize=None)
 def read_key(file_name):
     """Retrieves a GitHub API key from a file.
     
@@ -20,19 +55,16 @@ def read_key(file_name):
     key : str
     """
 
-    from os.path import dirname, join
-
     # Reads the first line of a file containing the GitHub API key
     # Usage: key = read_key('gh_key')
 
-    current_dir = dirname(__file__)
-    file2 = "./" + file_name
-    file_path = join(current_dir, file2)
+    file_path = join(_HERE, file_name)
 
     with open(file_path, 'r') as kf:
         key = kf.readline().rstrip() # remove newline & trailing whitespace
     return key
 
+@functools.lru_cache(maxsize=None)
 def read_orgs(file_name):
     """Retrieves a list of orgs from a file.
     
@@ -44,17 +76,195 @@ def read_orgs(file_name):
     -------
     org_list : list
     """
-    import csv
-
-    org_list = []
 
+    # The file has one org per line, so there is nothing for a csv reader
+    # to parse. Blank lines, like a trailing newline, are skipped.
     with open(file_name) as orgfile:
-        orgs = csv.reader(orgfile)
-        for row in orgs:
-            org_list.append(row[0])
+        org_list = [line.strip() for line in orgfile.read().splitlines() if line.strip()]
 
     return org_list
 
+def create_session(api_token, pool_maxsize=4):
+    """Creates a requests session for the GitHub API.
+
+    The session keeps connections to api.github.com open between
+    queries and retries requests that fail with a transient error.
+    
+    Parameters
+    ----------
+    api_token : str
+        The GH API token retrieved from the gh_key file.
+    pool_maxsize : int
+        The number of connections to keep open. This should be at least
+        the number of threads sharing the session.
+
+    Returns
+    -------
+    session : requests.Session
+    """
+
+    # GraphQL queries are sent as POST requests, but they only read data,
+    # so they are safe to retry along with everything else. Rate limited
+    # responses (403 and 429) are left to post_query, which waits for as
+    # long as GitHub asks instead of using the short backoff here.
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=None)
+
+    # requests already asks for gzip by default, but set it explicitly so the
+    # large repo listings always come back compressed.
+    session = requests.Session()
+    session.headers.update({'Authorization': 'token %s' % api_token, 'Accept-Encoding': 'gzip, deflate'})
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retries))
+
+    return session
+
+def rate_limit_wait(r, attempt=0):
+    """Returns the number of seconds to wait before retrying a response
+    that was rejected because of a GitHub rate limit, or None if the
+    response was not rate limited.
+
+    Rate limited responses have a 403 or 429 status. The session from
+    create_session does not retry these, so they are all handled here.
+
+    Parameters
+    ----------
+    r : requests.Response
+    attempt : int
+        The number of times the query has already been retried, used to
+        back off further when GitHub doesn't say how long to wait.
+
+    Returns
+    -------
+    wait : float
+    """
+
+    if r.status_code not in (403, 429):
+        return None
+
+    # Secondary rate limits say how long to wait, while running out of
+    # the hourly limit gives the time when it resets
+    if 'Retry-After' in r.headers:
+        return float(r.headers['Retry-After'])
+    if r.headers.get('X-RateLimit-Remaining') == '0':
+        return max(float(r.headers.get('X-RateLimit-Reset', 0)) - time.time(), 0) + 1
+
+    # A secondary rate limit without a Retry-After header should wait at
+    # least a minute, backing off more on each retry. Any other 403 is a
+    # real error, like a missing permission, and is not retried.
+    if r.status_code == 429 or 'rate limit' in r.text.lower():
+        return 60 * 2 ** attempt
+
+    return None
+
+def post_query(session, query, variables, cache_ttl=CACHE_TTL):
+    """Executes a GraphQL query against the GitHub API and returns the
+    decoded response, using a cached response if there is one that
+    is less than cache_ttl seconds old.
+
+    Temporary connection problems and server errors are retried by the
+    session. If the query hits a rate limit, it waits for as long as GitHub
+    asks and then tries again, and when the hourly limit is nearly used up
+    it waits for the limit to reset before returning. Any other error
+    response raises a requests.HTTPError. Responses with GraphQL errors
+    are returned but not cached.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session created by create_session with the GH API token.
+    query : str
+    variables : dict
+    cache_ttl : int
+        The number of seconds a cached response can be used for, or 0
+        to always query the API.
+
+    Returns
+    -------
+    json_data : dict
+    """
+
+    url = 'https://api.github.com/graphql'
+    payload = {'query': query, 'variables': variables}
+
+    if cache_ttl:
+        # The token is part of the key since different tokens can see different data
+        key = json.dumps(payload, sort_keys=True) + session.headers.get('Authorization', '')
+        cache_dir = join(_HERE, 'cache')
+        cache_file = join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json.gz')
+
+        try:
+            if time.time() - os.path.getmtime(cache_file) < cache_ttl:
+                with gzip.open(cache_file, 'rb') as cf:
+                    return json_lib.loads(cf.read())
+            os.remove(cache_file)
+        except OSError:
+            pass
+
+    max_attempts = 3
+    for attempt in range(max_attempts):
+        r = session.post(url, json=payload, timeout=30)
+        wait = rate_limit_wait(r, attempt)
+        if wait is None or attempt == max_attempts - 1:
+            break
+        print("Rate limited by the GitHub API, waiting", round(wait), "seconds")
+        time.sleep(wait)
+
+    r.raise_for_status()
+
+    remaining = r.headers.get('X-RateLimit-Remaining')
+    if remaining is not None and int(remaining) < RATE_LIMIT_BUFFER:
+        wait = max(float(r.headers.get('X-RateLimit-Reset', 0)) - time.time(), 0) + 1
+        print("Only", remaining, "GitHub API requests left, waiting", round(wait), "seconds for the rate limit to reset")
+        time.sleep(wait)
+
+    json_data = json_lib.loads(r.content)
+
+    # GitHub reports query timeouts and other GraphQL errors with a 200
+    # status, so only cache responses that have data and no errors
+    if cache_ttl and 'errors' not in json_data and json_data.get('data') is not None:
+        # Write to a temporary file first so that other threads never
+        # read a partly written cache file
+        tmp_file = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb') as cf:
+                cf.write(r.content)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            if tmp_file:
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+    return json_data
+
+def create_file(pre_string):
+    """Creates a csv file in the output folder named with pre_string
+    and today's date, for example output/pre_string_2022-01-14.csv
+
+    The file is opened with a large buffer so that writing many rows
+    results in fewer write calls.
+
+    Parameters
+    ----------
+    pre_string : str
+
+    Returns
+    -------
+    file : file object
+    writer : csv.writer
+    file_path : str
+    """
+
+    today = datetime.today().strftime('%Y-%m-%d')
+    file_path = join(_HERE, 'output', pre_string + '_' + today + '.csv')
+
+    file = open(file_path, 'w', newline='', buffering=1024 * 1024)
+    writer = csv.writer(file)
+
+    return file, writer, file_path
+
 def expand_name_df(df,old_col,new_col):
     """Takes a dataframe df with an API JSON object with nested elements in old_col, 
     extracts the name, and saves it in a new dataframe column called new_col
@@ -70,25 +280,9 @@ def expand_name_df(df,old_col,new_col):
     df : dataframe
     """
     
-    import pandas as pd
-
-    def expand_name(nested_name):
-        """Takes an API JSON object with nested elements and extracts the name
-        Parameters
-        ----------
-        nested_name : JSON API object
-
-        Returns
-        -------
-        object_name : str
-        """
-        if pd.isnull(nested_name):
-            object_name = 'Not Found'
-        else:
-            object_name = nested_name['name']
-        return object_name
-
-    df[new_col] = df[old_col].apply(expand_name)
+    # Missing objects come back from the API as None (or NaN once they
+    # are in a dataframe), so anything that isn't a dict is not found
+    df[new_col] = df[old_col].map(lambda nested_name: nested_name['name'] if isinstance(nested_name, dict) else 'Not Found')
     return df
     
 
@@ -33,22 +33,19 @@ output/inclusivity_check_2022-01-14.csv"
 """
 
 import sys
-from common_functions import read_key, expand_name_df
+import functools
+import pandas as pd
+from requests.exceptions import RequestException
+from concurrent.futures import ThreadPoolExecutor
+from common_functions import read_key, read_orgs, create_session, post_query
 from datetime import datetime
 from os.path import dirname, join
 
-def make_query(after_cursor = None):
-    """Creates and returns a GraphQL query with cursor for pagination"""
-
-    return """query RepoQuery($org_name: String!) {
-             organization(login: $org_name) {
-               repositories (first: 5 after: AFTER){
-                 pageInfo {
-                   hasNextPage
-                   endCursor
-                 }
-                 nodes { 
-                   nameWithOwner
+# Repository fields requested by both the single org and batched queries.
+# This is a GraphQL fragment, so the batched query only lists the fields
+# once instead of once per org.
+REPO_FIELDS = """fragment RepoFields on Repository {
+                    nameWithOwner
                     defaultBranchRef {
                         name 
                     }
@@ -59,12 +56,51 @@ def make_query(after_cursor = None):
                     isFork
                     isEmpty
                     isArchived
+        }"""
+
+# GraphQL query for one page of an org's repositories. The cursor for
+# pagination is passed in the after variable, so the query text is the
+# same for every page and only needs to be built once.
+QUERY = """query RepoQuery($org_name: String!, $after: String) {
+             organization(login: $org_name) {
+               repositories (first: 100 after: $after){
+                 pageInfo {
+                   hasNextPage
+                   endCursor
+                 }
+                 nodes {
+                   ...RepoFields
                  }
                 }
              }
-        }""".replace(
-        "AFTER", '"{}"'.format(after_cursor) if after_cursor else "null"
-    )
+        }
+""" + REPO_FIELDS
+
+@functools.lru_cache(maxsize=None)
+def make_batch_query(num_orgs):
+    """Creates and returns a GraphQL query that gets the first page of
+    repositories for num_orgs orgs at once using aliases. The orgs are
+    passed in the variables org0, org1, etc. and the results are
+    returned under the same names. The query is cached since every
+    batch except the last one has the same number of orgs."""
+
+    org_query = """
+             orgN: organization(login: $orgN) {
+               repositories (first: 100){
+                 pageInfo {
+                   hasNextPage
+                   endCursor
+                 }
+                 nodes {
+                   ...RepoFields
+                 }
+                }
+             }"""
+
+    params = ", ".join("$org{}: String!".format(i) for i in range(num_orgs))
+    orgs = "".join(org_query.replace("orgN", "org{}".format(i)) for i in range(num_orgs))
+
+    return "query BatchRepoQuery(" + params + ") {" + orgs + "\n        }\n" + REPO_FIELDS
 
 # Read GitHub key from file using the read_key function in 
 # common_functions.py
@@ -75,8 +111,97 @@ except:
     print("Error reading GH Key. This script depends on the existance of a file called gh_key containing your GitHub API token. Exiting")
     sys.exit()
 
+def get_first_pages(session, org_batch):
+    """Executes a single GraphQL query to get the first page of repository
+    data for several GitHub orgs.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session created by create_session with the GH API token.
+    org_batch : list
+        The names of the orgs to query together.
+
+    Returns
+    -------
+    first_pages : dict
+        The repositories object for each org name, or None if that
+        org could not be processed.
+    """
+
+    for org_name in org_batch:
+        print("Processing", org_name)
+
+    query = make_batch_query(len(org_batch))
+    variables = {"org" + str(i): org_name for i, org_name in enumerate(org_batch)}
+
+    try:
+        json_data = post_query(session, query, variables)
+        data = json_data['data'] or {}
+
+    except (RequestException, KeyError, TypeError, ValueError):
+        # Fall back to querying each org in the batch on its own
+        return {org_name: get_org_repos(session, org_name) for org_name in org_batch}
+
+    first_pages = {}
+    for i, org_name in enumerate(org_batch):
+        org = data.get("org" + str(i))
+        if org:
+            first_pages[org_name] = org['repositories']
+        else:
+            first_pages[org_name] = None
+            print("ERROR Cannot process", org_name)
+
+    return first_pages
+
+def get_org_repos(session, org_name, after_cursor = None):
+    """Executes the GraphQL query to get repository data from one GitHub org,
+    following the pagination until all repos have been retrieved.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session created by create_session with the GH API token.
+    org_name : str
+    after_cursor : str
+        The cursor to start from, or None to start from the first page.
+
+    Returns
+    -------
+    repositories : dict
+        A repositories object holding the nodes from every page.
+    """
+
+    repo_nodes = []
+    has_next_page = True
+
+    while has_next_page:
+
+        try:
+            variables = {"org_name": org_name, "after": after_cursor}
+            json_data = post_query(session, QUERY, variables)
+
+            repositories = json_data['data']['organization']['repositories']
+            page_info = repositories['pageInfo']
+
+            repo_nodes.extend(repositories['nodes'])
+
+            has_next_page = page_info['hasNextPage']
+
+            after_cursor = page_info['endCursor']
+        except (RequestException, KeyError, TypeError, ValueError):
+            has_next_page = False
+            print("ERROR Cannot process", org_name)
+
+    return {'nodes': repo_nodes}
+
 def get_repo_data(api_token):
-    """Executes the GraphQL query to get repository data from one or more GitHub orgs.
+    """Gets repository data from one or more GitHub orgs.
+
+    The first page for up to 10 orgs is requested in a single query,
+    and only orgs with more than one page of repos need further queries.
+    The queries run in parallel since the time is almost entirely spent
+    waiting on the API.
 
     Parameters
     ----------
@@ -87,15 +212,10 @@ def get_repo_data(api_token):
     -------
     repo_info_df : pandas.core.frame.DataFrame
     """
-    import requests
-    import json
-    import pandas as pd
-    from common_functions import read_orgs 
 
-    url = 'https://api.github.com/graphql'
-    headers = {'Authorization': 'token %s' % api_token}
-    
-    repo_info_df = pd.DataFrame()
+    max_workers = 8
+    batch_size = 10
+    session = create_session(api_token, pool_maxsize=max_workers)
     
     # Read list of orgs from a file
 
@@ -104,48 +224,40 @@ def get_repo_data(api_token):
     except:
         print("Error reading orgs. This script depends on the existance of a file called orgs.txt containing one org per line. Exiting")
         sys.exit()
-    
-    for org_name in org_list:  
-        has_next_page = True
-        after_cursor = None
-    
-        print("Processing", org_name)
 
-        while has_next_page:
+    batches = [org_list[i:i + batch_size] for i in range(0, len(org_list), batch_size)]
+    org_repos = {}
 
-            try:
-                query = make_query(after_cursor)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for first_pages in executor.map(lambda org_batch: get_first_pages(session, org_batch), batches):
+            org_repos.update(first_pages)
 
-                variables = {"org_name": org_name}
-                r = requests.post(url=url, json={'query': query, 'variables': variables}, headers=headers)
-                json_data = json.loads(r.text)
+        # Get the remaining pages for any orgs with more than 100 repos
+        more_pages = [org_name for org_name, repositories in org_repos.items()
+                      if repositories and repositories.get('pageInfo', {}).get('hasNextPage')]
+        remaining = executor.map(lambda org_name: get_org_repos(session, org_name, org_repos[org_name]['pageInfo']['endCursor']), more_pages)
 
-                df_temp = pd.DataFrame(json_data['data']['organization']['repositories']['nodes'])
-                repo_info_df = pd.concat([repo_info_df, df_temp])
+        for org_name, repositories in zip(more_pages, list(remaining)):
+            org_repos[org_name]['nodes'].extend(repositories['nodes'])
 
-                has_next_page = json_data["data"]["organization"]["repositories"]["pageInfo"]["hasNextPage"]
+    # Collect the repo nodes from every org in the same order as the orgs
+    # file and build the dataframe once to avoid copying it for every page
+    repo_nodes = []
+    for org_name in org_list:
+        if org_repos.get(org_name):
+            repo_nodes.extend(org_repos[org_name]['nodes'])
 
-                after_cursor = json_data["data"]["organization"]["repositories"]["pageInfo"]["endCursor"]
-            except:
-                has_next_page = False
-                print("ERROR Cannot process", org_name)
+    repo_info_df = pd.DataFrame(repo_nodes)
         
     return repo_info_df
 
 repo_info_df = get_repo_data(api_token)
 
-# This section reformats the output into what we need in the csv file
-repo_info_df = expand_name_df(repo_info_df,'defaultBranchRef','defaultBranch')
-
-def expand_coc(coc):
-    import pandas as pd
-    if pd.isnull(coc):
-        coc_url = 'Not Found'
-    else:
-        coc_url = coc['url']
-    return coc_url
-
-repo_info_df['codeOfConduct_url'] = repo_info_df['codeOfConduct'].apply(expand_coc)
+# This section reformats the output into what we need in the csv file.
+# The nested objects only hold a single value, so the new columns
+# are built directly from lists instead of applying a function per row.
+repo_info_df['defaultBranch'] = [branch['name'] if isinstance(branch, dict) else 'Not Found' for branch in repo_info_df['defaultBranchRef']]
+repo_info_df['codeOfConduct_url'] = [coc['url'] if isinstance(coc, dict) else 'Not Found' for coc in repo_info_df['codeOfConduct']]
 repo_info_df = repo_info_df.drop(columns=['defaultBranchRef', 'codeOfConduct'])
 
 # prepare file and write dataframe to csv
@@ -161,16 +273,13 @@ except:
     print('Could not write to csv file. This may be because the output directory is missing or you do not have permissions to write to it. Exiting')
 
 print("repo            branch   Code of Conduct")
-for rows in repo_info_df.iterrows():
-    repo = rows[1]['nameWithOwner']
-    branch = rows[1]['defaultBranch']
-    coc = rows[1]['codeOfConduct_url']
-    private = rows[1]['isPrivate']
-    fork = rows[1]['isFork']
-    empty = rows[1]['isEmpty']
-    archive = rows[1]['isArchived']
-    if private or fork or empty or archive:
-        pass
-    elif (branch == 'master' or  coc == 'Not Found'):
-        print(repo, branch, coc)
+
+# Skip private, forked, empty, and archived repos, and print the rest
+# only when they still use master or are missing a code of conduct
+skip = repo_info_df['isPrivate'] | repo_info_df['isFork'] | repo_info_df['isEmpty'] | repo_info_df['isArchived']
+needs_work = (repo_info_df['defaultBranch'] == 'master') | (repo_info_df['codeOfConduct_url'] == 'Not Found')
+report_df = repo_info_df.loc[~skip & needs_work, ['nameWithOwner', 'defaultBranch', 'codeOfConduct_url']]
+
+for repo, branch, coc in report_df.itertuples(index=False, name=None):
+    print(repo, branch, coc)
 print("\nMore details can be found in", file_path)
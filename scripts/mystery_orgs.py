@@ -22,18 +22,21 @@ As output:
 * A message about each org being processed will be printed to the screen.
 * the script creates a csv file stored in an subdirectory
   of the folder with the script called "output" with the filename in 
-  this format with today's date.
+  this format with today's date. The file has one row for each member
+  of each org, with the org details repeated on every row.
 
 output/mystery_orgs_2022-01-14.csv"
 """
 
 import sys
-from common_functions import read_key
-
-def make_query():
-    """Creates and returns a GraphQL query"""
-    return """query OrgQuery($org_name: String!) {
-             organization(login:$org_name) {
+import functools
+from requests.exceptions import RequestException
+from concurrent.futures import ThreadPoolExecutor
+from common_functions import read_key, read_orgs, create_file, create_session, post_query
+
+# The fields requested for each org. This is a GraphQL fragment, so the
+# batched query only lists the fields once instead of once per org.
+ORG_FIELDS = """fragment OrgFields on Organization {
                name
                url
                websiteUrl
@@ -47,9 +50,24 @@ def make_query():
                    company
                  }
                }
-              }
             }"""
 
+@functools.lru_cache(maxsize=None)
+def make_query(num_orgs):
+    """Creates and returns a GraphQL query that gets the data for num_orgs
+    orgs at once using aliases. The orgs are passed in the variables
+    org0, org1, etc. and the results are returned under the same names."""
+
+    org_query = """
+             orgN: organization(login:$orgN) {
+               ...OrgFields
+              }"""
+
+    params = ", ".join("$org{}: String!".format(i) for i in range(num_orgs))
+    orgs = "".join(org_query.replace("orgN", "org{}".format(i)) for i in range(num_orgs))
+
+    return "query OrgQuery(" + params + ") {" + orgs + "\n            }\n" + ORG_FIELDS
+
 # Read GitHub key from file using the read_key function in 
 # common_functions.py
 try:
@@ -59,8 +77,87 @@ except:
     print("Error reading GH Key. This script depends on the existance of a file called gh_key containing your GitHub API token. Exiting")
     sys.exit()
 
+def query_orgs(session, org_batch):
+    """Executes a single GraphQL query to get the data for several GitHub
+    orgs. If the query fails, each org is queried on its own, so that one
+    failed request doesn't drop the whole batch.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session created by create_session with the GH API token.
+    org_batch : list
+        The names of the orgs to query together.
+
+    Returns
+    -------
+    orgs : list
+        The org data for each org in the batch, or None for any org
+        that could not be retrieved.
+    """
+
+    query = make_query(len(org_batch))
+
+    variables = {"org" + str(i): org_name for i, org_name in enumerate(org_batch)}
+
+    try:
+        json_data = post_query(session, query, variables)
+        data = json_data['data'] or {}
+    except (RequestException, KeyError, TypeError, ValueError):
+        if len(org_batch) == 1:
+            return [None]
+        # Fall back to querying each org in the batch on its own
+        return [query_orgs(session, [org_name])[0] for org_name in org_batch]
+
+    return [data.get("org" + str(i)) for i in range(len(org_batch))]
+
+def get_org_rows(session, org_batch):
+    """Gets the org data for several GitHub orgs and formats it into csv rows.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session created by create_session with the GH API token.
+    org_batch : list
+        The names of the orgs to query together.
+
+    Returns
+    -------
+    rows : list
+        The rows in the csv file for the orgs in the batch, one per
+        member of each org. Orgs that could not be processed are skipped.
+    """
+
+    for org_name in org_batch:
+        print("Processing", org_name)
+
+    orgs = query_orgs(session, org_batch)
+
+    rows = []
+    for i in range(len(org_batch)):
+        org = orgs[i]
+
+        # Write one row per member with the org data repeated on each row,
+        # so every row has the same columns as the header. Orgs without any
+        # visible members still get a single row with the member fields blank.
+        try:
+            org_fields = [org['name'], org['url'], org['websiteUrl'], org['createdAt'], org['updatedAt']]
+            members = org['membersWithRole']['nodes']
+        except (KeyError, TypeError):
+            print("ERROR Cannot process", org_batch[i])
+            continue
+
+        if not members:
+            rows.append(org_fields + [None, None, None, None])
+        for member in members:
+            rows.append(org_fields + [member['login'], member['name'], member['email'], member['company']])
+
+    return rows
+
 def get_org_data(api_token):
-    """Executes the GraphQL query to get org data from one or more GitHub orgs.
+    """Gets org data from one or more GitHub orgs. Up to 10 orgs are
+    requested in a single query, and the queries are run in parallel
+    since the time is almost entirely spent waiting on the API.
 
     Parameters
     ----------
@@ -72,16 +169,9 @@ def get_org_data(api_token):
     Writes a csv file of the form 'mystery_orgs_2022-16-01.csv' with today's date
     """
 
-    import requests
-    import json
-    import sys
-    from os.path import dirname, join
-    import csv
-    from datetime import datetime
-    from common_functions import read_orgs
-
-    url = 'https://api.github.com/graphql'
-    headers = {'Authorization': 'token %s' % api_token}
+    max_workers = 8
+    batch_size = 10
+    session = create_session(api_token, pool_maxsize=max_workers)
     
     # Read list of orgs from a file
     try:
@@ -90,51 +180,22 @@ def get_org_data(api_token):
         print("Error reading orgs. This script depends on the existance of a file called orgs.txt containing one org per line. Exiting")
         sys.exit()
 
-    # Initialize list of lists with a header row.
-    # Each embedded list will become a row in the csv file
-    all_rows = [['org_name', 'org_url', 'website', 'org_createdAt', 'org_updatedAt', 'people(login,name,email,company):repeat']]
-    
-    for org_name in org_list:
-
-        print("Processing", org_name)
-
-        row = []
-        query = make_query()
-
-        variables = {"org_name": org_name}
-        r = requests.post(url=url, json={'query': query, 'variables': variables}, headers=headers)
-        json_data = json.loads(r.text)
-
-        # Take the json_data file and expand the info about people horizontally into the 
-        # same row as the rest of the data about that org.  
-        try:      
-            for key in json_data['data']['organization']:
-                if key == 'membersWithRole':
-                    for nkey in json_data['data']['organization'][key]['nodes']:
-                        row.append(nkey['login'])
-                        row.append(nkey['name'])
-                        row.append(nkey['email'])
-                        row.append(nkey['company'])
-                else:
-                    row.append(json_data['data']['organization'][key])
-            all_rows.append(row)
-        except:
-            pass
-        
-    # prepare file and write rows to csv
-
+    # prepare file and write the header row
     try:
-        today = datetime.today().strftime('%Y-%m-%d')
-        output_filename = "./output/mystery_orgs_" + today + ".csv"
-        current_dir = dirname(__file__)
-        file_path = join(current_dir, output_filename)
-        file = open(file_path, 'w', newline ='')
-
-        with file:    
-            write = csv.writer(file)
-            write.writerows(all_rows)
-
+        file, write, file_path = create_file("mystery_orgs")
     except:
         print('Could not write to csv file. This may be because the output directory is missing or you do not have permissions to write to it. Exiting')
+        sys.exit()
+
+    batches = [org_list[i:i + batch_size] for i in range(0, len(org_list), batch_size)]
+
+    # map() returns the rows in the same order as the orgs file, and each
+    # batch is written as soon as it is available
+    with file:
+        write.writerow(['org_name', 'org_url', 'website', 'org_createdAt', 'org_updatedAt', 'login', 'name', 'email', 'company'])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for rows in executor.map(lambda org_batch: get_org_rows(session, org_batch), batches):
+                write.writerows(rows)
 
 get_org_data(api_token)
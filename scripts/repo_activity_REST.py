@@ -13,8 +13,9 @@ information about all repositories from one or more GitHub
 orgs.
 
 This version runs much more slowly than the other GraphQL 
-version, and if there are a lot of orgs / repos, the API
-rate limit will be exceeded if the script is not slowed down.
+version, and if there are a lot of orgs / repos, the script
+will pause when the API rate limit is nearly used up until
+the limit resets.
 
 As input, this script requires a file named 'orgs.txt' containing
 the name of one GitHub org per line residing in the same folder 
@@ -23,7 +24,7 @@ as this script.
 Your API key should be stored in a file called gh_key in the
 same folder as this script.
 
-This script requires that `pandas` be installed within the Python
+This script requires that `PyGithub` be installed within the Python
 environment you are running this script in.
 
 As output:
@@ -36,13 +37,10 @@ output/a_repo_activity_2022-01-14.csv"
 """
 
 import sys
-import pandas as pd
 import csv
-from datetime import datetime
-from time import sleep
+from time import sleep, time
 from github import Github
-from os.path import dirname, join
-from common_functions import read_key
+from common_functions import read_key, create_file, RATE_LIMIT_BUFFER
 
 # Read GitHub key from file
 try:
@@ -55,15 +53,9 @@ except:
 
 # prepare csv file and write header row
 
-today = datetime.today().strftime('%Y-%m-%d')
-output_filename = "./output/a_repo_activity_" + today + ".csv"
-
 try:
-    current_dir = dirname(__file__)
-    file_path = join(current_dir, output_filename)
-
-    csv_output = open(file_path, 'w')
-    csv_output.write('org,repo,license,private,forked,archived,last_updated,last_pushed,last_committer_login,last_committer_name,last_committer_email,last_committer_date\n')
+    csv_output, writer, file_path = create_file("a_repo_activity")
+    writer.writerow(['org', 'repo', 'license', 'private', 'forked', 'archived', 'last_updated', 'last_pushed', 'last_committer_login', 'last_committer_name', 'last_committer_email', 'last_committer_date'])
 
 except:
     print('Could not write to csv file. Exiting')
@@ -81,7 +73,6 @@ with open('orgs.txt') as orgfile:
 
 for github_org in org_list:
 
-#    sleep(90) #add delay to slow down hitting rate limits
     print("Processing ", github_org)
 
     try:
@@ -92,35 +83,44 @@ for github_org in org_list:
 
     try:
         for x in org.get_repos():
+
+            # Wait for the rate limit to reset when it is nearly used up.
+            # PyGithub keeps the limit from the headers of the last response.
+            remaining, _ = g.rate_limiting
+            if 0 <= remaining < RATE_LIMIT_BUFFER:
+                wait = max(g.rate_limiting_resettime - time(), 0) + 1
+                print("Only", remaining, "GitHub API requests left, waiting", round(wait), "seconds for the rate limit to reset")
+                sleep(wait)
+
             try:
+                # Only the first commit in the list is needed. The commit list
+                # already includes the git author and date, and the linked
+                # GitHub user's login, so no other calls are made for them.
+                y = None
                 for y in x.get_commits():
-                    try:
-                        author_login = y.author.login
-                        author_name = y.author.name
-                        author_email = y.author.email
-                        break
-                    except:
-                        author_login = None
-                        author_name = None
-                        author_email = None
-                        
+                    break
 
                 try:
-                    last_commit_date = x.get_commit(y.sha).commit.author.date
+                    author_login = y.author.login if y.author else None
+                    author_name = y.commit.author.name
+                    author_email = y.commit.author.email
+                    last_commit_date = y.commit.author.date
                 except:
+                    author_login = None
+                    author_name = None
+                    author_email = None
                     last_commit_date = "No commits, repo may be empty"
 
-                # When this fails it usually means there is no license
-                try:
-                    license = x.get_license().license.name
-                except:
-                    license = "Likely Unlicensed" 
+                # The license is included in the repo list from get_repos(),
+                # when it is missing there is usually no license
+                license = x.license.name if x.license else "Likely Unlicensed"
 
-                csv_string = github_org + ',' + x.full_name + ',' + str(license) + ',' + str(x.private) + ',' + str(x.fork) + ',' + str(x.archived) + ',' + str(x.updated_at) + ',' + str(x.pushed_at) + ',' + str(author_login) + ',' + str(author_name) + ',' + str(author_email) + ',' + str(last_commit_date) + '\n'
-                csv_output.write(csv_string)
+                writer.writerow([github_org, x.full_name, license, x.private, x.fork, x.archived, x.updated_at, x.pushed_at, author_login, author_name, author_email, last_commit_date])
             except: 
                 print("Cannot process data for", x) 
-                csv_output.write(github_org + ',' + x.full_name + ',' + str(x.private) + ',' + str(x.fork) + ',' + str(x.archived) + ',' + str(x.updated_at) + ',' + str(x.pushed_at) + ',' + 'Error' + ',' + 'Error' + ',' + 'Error' + ',' + 'Error' + '\n')
+                writer.writerow([github_org, x.full_name, 'Error', x.private, x.fork, x.archived, x.updated_at, x.pushed_at, 'Error', 'Error', 'Error', 'Error'])
 
     except:
          print("Cannot get repos for", github_org)
+
+csv_output.close()
@@ -43,22 +43,27 @@ As output:
   this format with today's date.
 
 output/a_repo_activity_2022-01-14.csv"
+
+Getting the last commit for each repo is the most expensive part of
+the query for GitHub to run. If you don't need the last commit date
+and author, run the script with --no-last-commit to skip them, and
+those columns will be left empty.
 """
 
 import sys
+import argparse
 import pandas as pd
-import csv
-from datetime import datetime
-from time import sleep
-from os.path import dirname, join
-from common_functions import read_key, expand_name_df
-
-def make_query(after_cursor = None):
-    """Creates and returns a GraphQL query with cursor for pagination"""
-
-    return """query RepoQuery($org_name: String!) {
+from requests.exceptions import RequestException
+from concurrent.futures import ThreadPoolExecutor
+from common_functions import read_key, read_orgs, create_file, create_session, post_query
+
+# GraphQL query for one page of an org's repositories. The cursor for
+# pagination is passed in the after variable, so the query text is the
+# same for every page and only needs to be built once. The last commit
+# on the default branch is only included when last_commit is true.
+QUERY = """query RepoQuery($org_name: String!, $after: String, $last_commit: Boolean!) {
              organization(login: $org_name) {
-               repositories (first: 10 after: AFTER){
+               repositories (first: 10 after: $after){
                  pageInfo {
                    hasNextPage
                    endCursor
@@ -88,7 +93,7 @@ def make_query(after_cursor = None):
                    pushedAt
                    defaultBranchRef {
                      name 
-                     target{
+                     target @include(if: $last_commit){
                         ... on Commit{
                             history(first:1){
                         edges{
@@ -112,9 +117,11 @@ def make_query(after_cursor = None):
               }
               }
               }
-            }""".replace(
-        "AFTER", '"{}"'.format(after_cursor) if after_cursor else "null"
-    )
+            }"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--no-last-commit", action="store_true", help="skip the last commit date and author for each repo")
+args = parser.parse_args()
 
 # Read GitHub key from file using the read_key function in 
 # common_functions.py
@@ -125,135 +132,158 @@ except:
     print("Error reading GH Key. This script depends on the existance of a file called gh_key containing your GitHub API token. Exiting")
     sys.exit()
 
-def get_repo_data(api_token):
-    """Executes the GraphQL query to get repository data from one or more GitHub orgs.
+def get_org_repos(session, org_name, include_last_commit):
+    """Executes the GraphQL query to get repository data from one GitHub org,
+    following the pagination until all repos have been retrieved.
 
     Parameters
     ----------
-    api_token : str
-        The GH API token retrieved from the gh_key file.
+    session : requests.Session
+        The session created by create_session with the GH API token.
+    org_name : str
+    include_last_commit : bool
+        Whether to get the last commit on the default branch of each repo.
 
     Returns
     -------
-    repo_info_df : pandas.core.frame.DataFrame
+    repo_nodes : list
     """
-    import requests
-    import json
-    import pandas as pd
-    from common_functions import read_orgs
 
-    url = 'https://api.github.com/graphql'
-    headers = {'Authorization': 'token %s' % api_token}
-    
-    repo_info_df = pd.DataFrame()
-    
-    # Read list of orgs from a file
+    repo_nodes = []
+    has_next_page = True
+    after_cursor = None
 
-    try:
-        org_list = read_orgs('orgs.txt')
-    except:
-        print("Error reading orgs. This script depends on the existance of a file called orgs.txt containing one org per line. Exiting")
-        sys.exit()
-    
-    for org_name in org_list:  
-        has_next_page = True
-        after_cursor = None
-    
-        print("Processing", org_name)
+    print("Processing", org_name)
+
+    while has_next_page:
+
+        try:
+            variables = {"org_name": org_name, "after": after_cursor, "last_commit": include_last_commit}
+            json_data = post_query(session, QUERY, variables)
+
+            repositories = json_data['data']['organization']['repositories']
+            page_info = repositories['pageInfo']
 
-        while has_next_page:
+            repo_nodes.extend(repositories['nodes'])
 
-            try:
-                query = make_query(after_cursor)
+            has_next_page = page_info['hasNextPage']
 
-                variables = {"org_name": org_name}
-                r = requests.post(url=url, json={'query': query, 'variables': variables}, headers=headers)
-                json_data = json.loads(r.text)
+            after_cursor = page_info['endCursor']
+        except (RequestException, KeyError, TypeError, ValueError):
+            has_next_page = False
+            print("ERROR Cannot process", org_name)
 
-                df_temp = pd.DataFrame(json_data['data']['organization']['repositories']['nodes'])
-                repo_info_df = pd.concat([repo_info_df, df_temp])
+    return repo_nodes
 
-                has_next_page = json_data["data"]["organization"]["repositories"]["pageInfo"]["hasNextPage"]
+# Columns written to the csv file, in order
+REPO_COLUMNS = ['org','name','nameWithOwner','license','defaultBranch','codeOfConduct_url', 'contrib_file', 'isPrivate','isFork','isArchived', 'forkCount', 'stargazerCount', 'isEmpty', 'createdAt', 'updatedAt','pushedAt','last_commit_date','author_login','author_name','author_email']
 
-                after_cursor = json_data["data"]["organization"]["repositories"]["pageInfo"]["endCursor"]
-            except:
-                has_next_page = False
-                print("ERROR Cannot process", org_name)
-        
-    return repo_info_df
+# Types for the flag and count columns, so they are stored compactly
+# instead of depending on what pandas infers for each org
+REPO_DTYPES = {'isPrivate': 'bool', 'isFork': 'bool', 'isEmpty': 'bool', 'isArchived': 'bool',
+               'forkCount': 'int32', 'stargazerCount': 'int32'}
 
-repo_info_df = get_repo_data(api_token)
+def last_commit(edges):
+    """Returns the most recent commit node from the default branch history edges"""
+    if not isinstance(edges, list) or not edges:
+        return {}
+    return edges[0]['node']
 
-# This section reformats the output into what we need in the csv file
+def format_repo_data(repo_nodes):
+    """Reformats the repository data for an org into what we need in the csv file.
+
+    Parameters
+    ----------
+    repo_nodes : list
+        The repository nodes returned by the GraphQL query.
+
+    Returns
+    -------
+    repo_info_df : pandas.core.frame.DataFrame
+    """
 
-repo_info_df["org"] = repo_info_df["nameWithOwner"].str.split('/').str[0]
+    # json_normalize flattens the nested objects into columns like licenseInfo_name
+    repo_info_df = pd.json_normalize(repo_nodes, sep='_').astype(REPO_DTYPES)
 
-repo_info_df = expand_name_df(repo_info_df,'licenseInfo','license')
-repo_info_df = repo_info_df.drop(columns=['licenseInfo'])
+    repo_info_df["org"] = repo_info_df["nameWithOwner"].str.split('/').str[0]
 
-repo_info_df = expand_name_df(repo_info_df,'defaultBranchRef','defaultBranch')
+    # json_normalize leaves out a flattened column when that object was
+    # missing from every repo, so make sure all of them exist
+    nested_cols = ['licenseInfo_name', 'codeOfConduct_url', 'content_abbreviatedOid',
+                   'defaultBranchRef_name', 'defaultBranchRef_target_history_edges']
+    repo_info_df = repo_info_df.reindex(columns=repo_info_df.columns.union(nested_cols, sort=False))
 
-def expand_coc(coc):
-    if pd.isnull(coc):
-        coc_url = 'Likely Missing'
-    else:
-        coc_url = coc['url']
-    return coc_url
+    repo_info_df = repo_info_df.rename(columns={'licenseInfo_name': 'license', 'defaultBranchRef_name': 'defaultBranch'})
+    repo_info_df[['license', 'defaultBranch']] = repo_info_df[['license', 'defaultBranch']].fillna('Not Found')
 
-repo_info_df['codeOfConduct_url'] = repo_info_df['codeOfConduct'].apply(expand_coc)
-repo_info_df = repo_info_df.drop(columns=['codeOfConduct'])
+    repo_info_df['codeOfConduct_url'] = repo_info_df['codeOfConduct_url'].fillna('Likely Missing')
 
-def expand_contrib(contrib):
     # Note that the script only finds the file if it exactly matches CONTRIBUTING.md
     # and will not find contributing.md, CONTRIBUTING.rst, or other variations
-    if pd.isnull(contrib):
-        contrib_file = 'Missing Private or not CONTRIBUTING.md'
-    else:
-        contrib_file = 'CONTRIBUTING.md'
-    return contrib_file
-
-repo_info_df['contrib_file'] = repo_info_df['content'].apply(expand_contrib)
-repo_info_df = repo_info_df.drop(columns=['content'])
-
-def expand_commits(commits):
-    if pd.isnull(commits):
-        commits_list = [None, None, None, None]
-    else:
-        node = commits['target']['history']['edges'][0]['node']
-        try:
-            commit_date = node['committedDate']
-        except:
-            commit_date = None
-        try:
-            author_name = node['author']['name']
-        except:
-            author_name = None
-        try:
-            author_email = node['author']['email']
-        except:
-            author_email = None
-        try:
-            author_login = node['author']['user']['login']
-        except:
-            author_login = None
-        commits_list = [commit_date, author_name, author_email, author_login]
-    return commits_list
+    repo_info_df['contrib_file'] = repo_info_df['content_abbreviatedOid'].notna().map({True: 'CONTRIBUTING.md', False: 'Missing Private or not CONTRIBUTING.md'})
+
+    # Build the last commit columns directly from lists rather than applying
+    # a function to each row and splitting an intermediate list column
+    commits = [last_commit(edges) for edges in repo_info_df['defaultBranchRef_target_history_edges']]
+    authors = [commit.get('author') or {} for commit in commits]
+    repo_info_df['last_commit_date'] = [commit.get('committedDate') for commit in commits]
+    repo_info_df['author_name'] = [author.get('name') for author in authors]
+    repo_info_df['author_email'] = [author.get('email') for author in authors]
+    repo_info_df['author_login'] = [(author.get('user') or {}).get('login') for author in authors]
 
-repo_info_df['commits_list'] = repo_info_df['defaultBranchRef'].apply(expand_commits)
-repo_info_df[['last_commit_date','author_name','author_email', 'author_login']] = pd.DataFrame(repo_info_df.commits_list.tolist(), index= repo_info_df.index)
-repo_info_df = repo_info_df.drop(columns=['commits_list','defaultBranchRef'])
+    return repo_info_df[REPO_COLUMNS]
 
-repo_info_df = repo_info_df[['org','name','nameWithOwner','license','defaultBranch','codeOfConduct_url', 'contrib_file', 'isPrivate','isFork','isArchived', 'forkCount', 'stargazerCount', 'isEmpty', 'createdAt', 'updatedAt','pushedAt','last_commit_date','author_login','author_name','author_email']] 
+def get_repo_data(api_token, file, include_last_commit):
+    """Gets repository data from one or more GitHub orgs and writes it to
+    the csv file. The orgs are queried in parallel since the time is almost
+    entirely spent waiting on the API.
 
-# prepare file and write dataframe to csv
+    Each org is written as soon as its repos have been retrieved, so only
+    the orgs that have been retrieved but not yet written are held in memory,
+    rather than the data for every org.
+
+    Parameters
+    ----------
+    api_token : str
+        The GH API token retrieved from the gh_key file.
+    file : file object
+        The csv file to write to.
+    include_last_commit : bool
+        Whether to get the last commit on the default branch of each repo.
+    """
+
+    max_workers = 8
+    session = create_session(api_token, pool_maxsize=max_workers)
+    
+    # Read list of orgs from a file
+
+    try:
+        org_list = read_orgs('orgs.txt')
+    except:
+        print("Error reading orgs. This script depends on the existance of a file called orgs.txt containing one org per line. Exiting")
+        sys.exit()
+
+    # map() returns the results in the same order as the orgs file
+    header = True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for org_nodes in executor.map(lambda org_name: get_org_repos(session, org_name, include_last_commit), org_list):
+            if org_nodes:
+                format_repo_data(org_nodes).to_csv(file, index=False, header=header)
+                header = False
+
+    # Still write the header row if no repos were found
+    if header:
+        pd.DataFrame(columns=REPO_COLUMNS).to_csv(file, index=False)
+
+# prepare file and write the data for each org to csv as it is retrieved
 
 try:
-    today = datetime.today().strftime('%Y-%m-%d')
-    output_filename = "./output/a_repo_activity_" + today + ".csv"
-    current_dir = dirname(__file__)
-    file_path = join(current_dir, output_filename)
-    repo_info_df.to_csv(file_path, index=False)
+    file, write, file_path = create_file("a_repo_activity")
 
 except:
     print('Could not write to csv file. This may be because the output directory is missing or you do not have permissions to write to it. Exiting')
+    sys.exit()
 
+with file:
+    get_repo_data(api_token, file, not args.no_last_commit)